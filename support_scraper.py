@@ -25,17 +25,65 @@ This software is provided without support, warranty, or guarantee.
 Use at your own risk.
 '''
 
+import asyncio
+from collections import defaultdict
+from contextlib import asynccontextmanager, suppress
+from http.cookies import SimpleCookie
 import logging
 from logging.config import dictConfig
 import os
-from time import sleep, time
+import pickle
+import tempfile
+from time import mktime, monotonic, sleep, strptime, time
+from urllib.parse import urljoin, urlparse
 
+import aiohttp
 from dotenv import load_dotenv
+from lxml import etree
+import lxml.html
 from selenium import webdriver
-from selenium.common.exceptions import ElementClickInterceptedException
+from selenium.common.exceptions import InvalidCookieDomainException, TimeoutException
 from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.common.by import By
+from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
+from selenium.webdriver.support import expected_conditions
+from selenium.webdriver.support.ui import WebDriverWait
 
 
+_LOG = logging.getLogger(__name__)
+
+# Where each update page lives, and where the portal sends you when you're logged out.
+_UPDATES_URL = 'https://support.paloaltonetworks.com/Updates/{}Updates/'
+_LOGGED_OUT_URL = 'https://support.paloaltonetworks.com/Support/Index'
+
+# Finds the Updates grid in the browser.
+_GRID_LOCATOR = (By.ID, 'Grid')
+
+# Compiled once; these walk the Updates grid.
+_GRID_TBODY = etree.XPath('//*[@id="Grid"]/table/tbody')
+_GRID_TRS = etree.XPath('.//tr')
+# Hidden cells are dropped by the query itself rather than filtered afterwards. The style
+# attribute is as the server wrote it, so ignore case and spacing ("display:none", "DISPLAY: NONE").
+# (translate() drops the trailing space since it has no partner in the lowercase alphabet.)
+_GRID_SHOWING_TDS = etree.XPath('./td[not(contains(translate(@style, "ABCDEFGHIJKLMNOPQRSTUVWXYZ ", '
+                                '"abcdefghijklmnopqrstuvwxyz"), "display:none"))]')
+# A header's title is the text after its icon, with the whitespace cleaned up.
+_GRID_HEADER = etree.XPath('normalize-space(./td/p/text()[last()])')
+_GRID_HREF = etree.XPath('.//a/@href')
+
+# Be polite to the portal: at most this many requests at once, and this many seconds
+# between starting requests to the same host.
+_MAX_REQUESTS = 8
+_REQUEST_INTERVAL = 0.2
+
+# How long to trust saved cookies that don't say when they expire.
+_COOKIE_LIFETIME = 24 * 60 * 60
+
+# How much of a response to read at a time when saving it.
+_CHUNK_SIZE = 64 * 1024
+# Size in bytes of the buffer chunks collect in before being written to disk.
+_WRITE_BUFFER = 1 << 20
+
 
 class SupportScraper:
     '''
@@ -44,152 +92,540 @@ class SupportScraper:
     Non-keyword arguments:
     chrome_driver -- the name of the Chrome driver to use
     binary_location -- the path to the Chrome binary
-    download_dir -- the default directory where Chrome downloads files
+    download_dir -- the directory to save downloaded files to
     login_time -- how long we wait for you to log in
+    cookie_file -- where to save the login between runs
+    headless -- whether to hide the Chrome window; only works once you have a saved login
+    remote_url -- a Selenium Grid to run Chrome on instead of starting a local Chrome driver
 
     '''
     def __init__(self, chrome_driver='chromedriver',
                  binary_location='/Applications/Google Chrome Canary.app/Contents/MacOS/Google Chrome Canary',
-                 download_dir=f"{os.getenv('HOME')}/Downloads", login_time=60):
+                 download_dir=f"{os.getenv('HOME')}/Downloads", login_time=60, cookie_file=None,
+                 headless=False, remote_url=None):
+        self._headless = str(headless).lower() in ('1', 'true', 'yes')
+        # You can only log in by hand in a Chrome window on this machine.
+        self._can_log_in = not (self._headless or remote_url)
+
         # Set up driver
         chrome_options = Options()
-        chrome_options.binary_location = binary_location
+        if not remote_url:
+            # A grid node knows where its own Chrome is.
+            chrome_options.binary_location = binary_location
         # chrome_options.add_argument('--no-sandbox')
         # chrome_options.add_argument('--disable-dev-shm-usage')
         # chrome_options.add_argument('--remote-debugging-port=9222')
-        # chrome_options.add_argument('--headless')
-        self._driver = webdriver.Chrome(executable_path=os.path.abspath(chrome_driver),
-                                        options=chrome_options)
+        if self._headless:
+            chrome_options.add_argument('--headless')
+            chrome_options.add_argument('--disable-gpu')
+        # We only ever look for the grid, so don't bother loading images.
+        chrome_options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
+        # Don't wait on anything past the DOM.
+        capabilities = DesiredCapabilities.CHROME.copy()
+        capabilities['pageLoadStrategy'] = 'eager'
+        if remote_url:
+            self._driver = webdriver.Remote(command_executor=remote_url,
+                                            options=chrome_options,
+                                            desired_capabilities=capabilities)
+        else:
+            self._driver = webdriver.Chrome(executable_path=os.path.abspath(chrome_driver),
+                                            options=chrome_options,
+                                            desired_capabilities=capabilities)
 
         # Init details
         self._download_dir = download_dir
         self.contents = {}
-        self._main_handle = None
-        self._on_update_page = None
+        self._latest_idx = {}
+        self._pages = {}
+        self._session = None
+        self._semaphore = None
+        self._next_request = {}
+        self._done = {}
+        self._path_locks = {}
+        self._saved_paths = set()
+        self._login_lock = None
+        self._logins = 0
+        self._cookie_file = cookie_file or os.path.join(os.getenv('HOME'), '.pancookies.pkl')
         try:
             self._login_time = int(login_time)
         except ValueError:
             # Can't convert to an int; use a default.
             self._login_time = 60
 
-        self._login()
+        try:
+            self._login()
+        except Exception:
+            self._driver.quit()
+            raise
+
 
+    def __enter__(self):
+        return self
 
-    def __del__(self):
-        # Wait for files to finish downloading before we close out.
-        logging.info("Waiting for all files to finish downloading.")
-        sleep(5)  # let the driver start downloading
-        file_list = self._list_all_download_files()
-        while 'Unconfirmed' in file_list or 'crdownload' in file_list:
-            file_list = self._list_all_download_files()
-            sleep(1)
-        logging.info(f"Finished downloading everything. Any files downloaded may be found in {self._download_dir}")
-        self._driver.close()
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            _LOG.info("Finished downloading everything. Any files downloaded may be found in %s", self._download_dir)
+        self._driver.quit()
 
 
     def _login(self):
         '''Log into support portal.'''
-        # Until somebody drops the 2FA, use a manual login.
-        self._driver.get(f"https://support.paloaltonetworks.com/")
-        logging.info("USER INTERACTION REQUIRED: Please log in.")
-        self._driver.get(f'https://identity.paloaltonetworks.com/idp/startSSO.ping?PartnerSpId=supportCSP&TargetResource=https://support.paloaltonetworks.com')
-        # Log in now. You have 1 minute.
-        sleep(self._login_time)
-        # Now we're logged in. Carry on with the rest of the script.
-        logging.info("Finished waiting for you to log in.")
+        if self._restore_cookies() and self._logged_in():
+            _LOG.info("Reusing saved login.")
+        else:
+            # Until somebody drops the 2FA, use a manual login.
+            if not self._can_log_in:
+                raise RuntimeError("No saved login to use, and you can't log in without a local Chrome window. "
+                                   "Run once with HEADLESS=false and without SELENIUM_REMOTE_URL to save one.")
+            self._driver.get(f"https://support.paloaltonetworks.com/")
+            _LOG.info("USER INTERACTION REQUIRED: Please log in.")
+            self._driver.get(f'https://identity.paloaltonetworks.com/idp/startSSO.ping?PartnerSpId=supportCSP&TargetResource=https://support.paloaltonetworks.com')
+            # Log in now. You have 1 minute.
+            sleep(self._login_time)
+            # Now we're logged in. Carry on with the rest of the script.
+            _LOG.info("Finished waiting for you to log in.")
+        self._save_cookies()
+        self._logins += 1
+
+
+    async def _relogin(self, logins):
+        '''
+        Log in again without blocking the downloads already running.
+
+        Non-keyword arguments:
+        logins -- how many logins there had been when the caller found itself logged out
+        '''
+        if self._login_lock is None:
+            self._login_lock = asyncio.Lock()
+        async with self._login_lock:
+            if self._logins != logins:
+                # Somebody else logged in while we waited for the lock.
+                return
+            await asyncio.get_running_loop().run_in_executor(None, self._login)
+            # Hand the fresh login over to the HTTP session.
+            self._session.cookie_jar.clear()
+            self._load_cookies(self._session.cookie_jar)
+
+
+    def _restore_cookies(self):
+        '''
+        Put the cookies saved by a previous run back into the browser.
+
+        Returns whether there were unexpired cookies to restore.
+        '''
+        try:
+            with open(self._cookie_file, 'rb') as file:
+                saved = pickle.load(file)
+            expires, cookies = saved['expires'], list(saved['cookies'])
+            expired = expires <= time()
+        except Exception:
+            # Missing, from an older version, or otherwise unreadable; same as not having one.
+            _LOG.debug("No usable saved cookies in %s.", self._cookie_file)
+            return False
+        if expired:
+            _LOG.debug("Saved cookies have expired.")
+            return False
+
+        # The browser only takes cookies for the site it's on.
+        self._driver.get('https://support.paloaltonetworks.com/')
+        for cookie in cookies:
+            try:
+                self._driver.add_cookie(cookie)
+            except InvalidCookieDomainException:
+                # Belongs to the identity provider; the support portal session is what we need.
+                pass
+        return True
 
 
-    def _find_update_page(self, update_type):
+    def _logged_in(self):
+        '''Check whether the browser can see the updates grid.'''
+        self._driver.get(_UPDATES_URL.format('Dynamic'))
+        try:
+            WebDriverWait(self._driver, 3).until(expected_conditions.presence_of_element_located(_GRID_LOCATOR))
+        except TimeoutException:
+            return False
+        return True
+
+
+    def _save_cookies(self):
+        '''Save the browser's cookies, and when they run out, for the next run.'''
+        cookies = self._driver.get_cookies()
+        # Short-lived tracking cookies shouldn't throw the login away; it's only surely dead once
+        # the last cookie is, and _logged_in checks whether it actually still works.
+        expiries = [cookie['expiry'] for cookie in cookies if 'expiry' in cookie]
+        expires = max(expiries) if expiries else time() + _COOKIE_LIFETIME
+        # These are a live login; keep them to ourselves.
+        fd = os.open(self._cookie_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.chmod(self._cookie_file, 0o600)  # in case an older run left it readable
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump({'expires': expires, 'cookies': cookies}, file)
+
+
+    def _load_cookies(self, jar):
         '''
-        Navigate to get the links and details.
+        Copy the browser's cookies into an aiohttp cookie jar.
+
+        Non-keyword arguments:
+        jar -- the aiohttp.CookieJar to fill
+        '''
+        for cookie in self._driver.get_cookies():
+            morsel = SimpleCookie()
+            morsel[cookie['name']] = cookie['value']
+            morsel[cookie['name']]['domain'] = cookie['domain']
+            morsel[cookie['name']]['path'] = cookie.get('path', '/')
+            jar.update_cookies(morsel)
+
+
+    def _get_session(self):
+        '''Get the HTTP session that shares the browser's login, opening it if needed.'''
+        if self._session is None:
+            jar = aiohttp.CookieJar()
+            self._load_cookies(jar)
+            self._session = aiohttp.ClientSession(cookie_jar=jar,
+                                                  connector=aiohttp.TCPConnector(limit=20))
+        return self._session
+
+
+    @asynccontextmanager
+    async def _get(self, url):
+        '''
+        GET a url with the shared session, waiting for our turn if the portal is busy.
+
+        Non-keyword arguments:
+        url -- the url to get
+        '''
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(_MAX_REQUESTS)
+        async with self._semaphore:
+            # Claim the next free start time for this host before sleeping, so
+            # requests waiting alongside us line up behind it.
+            host = urlparse(url).netloc
+            start = max(monotonic(), self._next_request.get(host, 0))
+            self._next_request[host] = start + _REQUEST_INTERVAL
+            await asyncio.sleep(start - monotonic())
+            async with self._get_session().get(url) as resp:
+                yield resp
+
+
+    async def close(self):
+        '''Close the HTTP session. Call from the event loop once done downloading.'''
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+    async def _find_update_page(self, update_type):
+        '''
+        Fetch the update page and read in the links and details.
 
         Non-keyword arguments:
         update_type -- a string determining update page to get from (Dynamic or Software)
 
         '''
-        self._driver.get(f"https://support.paloaltonetworks.com/Updates/{update_type}Updates/")
-        while self._driver.current_url == 'https://support.paloaltonetworks.com/Support/Index':
+        url = _UPDATES_URL.format(update_type)
+        while True:
+            logins = self._logins
+            async with self._get(url) as resp:
+                if str(resp.url) != _LOGGED_OUT_URL:
+                    page_url = str(resp.url)
+                    html = await resp.text()
+                    break
             # Keep trying to log in.
-            self._login()
-            self._driver.get(f"https://support.paloaltonetworks.com/Updates/{update_type}Updates/")
-        logging.debug("Logged into support portal.")
+            await self._relogin(logins)
+        _LOG.debug("Logged into support portal.")
+
+        root = lxml.html.fromstring(html)
+        tbodies = _GRID_TBODY(root)
+        if not tbodies:
+            raise RuntimeError(f"No updates grid on {page_url}")
+        tbody = tbodies[0]
+
+        header = None
+        self.contents[update_type] = {}
+        self._latest_idx[update_type] = {}
+        for tr in _GRID_TRS(tbody):
+            if tr.get('class') == 'k-grouping-row':
+                # It's a header
+                header = _GRID_HEADER(tr)
+            elif header is not None:
+                # It's an update
+                showing_tds = _GRID_SHOWING_TDS(tr)
+                update = {}
+                update['version'] = showing_tds[1].text_content().strip()
+                update['date'] = showing_tds[2].text_content()
+                try:
+                    update['date_ts'] = int(mktime(strptime(update['date'].strip(), '%m/%d/%Y')))
+                except ValueError:
+                    _LOG.warning("Can't read the date %r of %s %s; ranking it oldest.",
+                                 update['date'], header, update['version'])
+                    update['date_ts'] = None
+                update['notes'] = self._href(page_url, showing_tds[3])
+                update['download'] = self._href(page_url, showing_tds[4])
+                # Keep track of the newest as we go, so nobody has to search for it later.
+                releases = self.contents[update_type].setdefault(header, [])
+                latest = self._latest_idx[update_type].get(header)
+                if latest is None or _date_rank(update) > _date_rank(releases[latest]):
+                    self._latest_idx[update_type][header] = len(releases)
+                releases.append(update)
+
+        _LOG.debug("Finished reading in updates for %s Updates.", update_type)
+        _LOG.debug(self.contents[update_type])
+
+
+    @staticmethod
+    def _href(page_url, td):
+        '''Get the absolute link out of a grid cell, or None if it has no link.'''
+        hrefs = _GRID_HREF(td)
+        return urljoin(page_url, hrefs[0]) if hrefs else None
+
+
+    def _latest_release(self, update_type, key):
+        '''
+        Get the newest release in a section of an update page that has been read in.
+
+        Non-keyword arguments:
+        update_type -- a string determining update page to get from (Dynamic or Software)
+        key -- a string showing the section to get the release from
+        '''
+        return self.contents[update_type][key][self._latest_idx[update_type][key]]
 
-        tbody = self._driver.find_element_by_xpath('//*[@id="Grid"]/table/tbody')
-        trs = tbody.find_elements_by_xpath(".//tr")
 
-        header = "NULL"
-        try:
-            self.contents[update_type]
-        except KeyError:
-            # Get new contents.
-            self.contents[update_type] = {}
-
-            for tr in trs:
-                if tr.get_attribute('class') == 'k-grouping-row':
-                    # It's a header
-                    header = str(tr.find_element_by_xpath('./td/p').get_attribute('innerHTML')).split('>')[-1]
-                    # Clean the header
-                    header = ' '.join(header.split())
-                    new_section = True
-                elif new_section:
-                    # It's an update
-                    tds = tr.find_elements_by_xpath('./td')
-                    showing_tds = [td for td in tds if 'display: none' not in td.get_attribute('style')]
-                    update = {}
-                    update['version'] = showing_tds[1].get_attribute('innerHTML')
-                    update['date'] = showing_tds[2].get_attribute('innerHTML')
-                    update['notes'] = showing_tds[3]
-                    update['download'] = showing_tds[4]
-                    self.contents[update_type][header] = update
-                    new_section = False
-
-        # Save this as the base window before getting adventurous.
-        self._main_handle = self._driver.current_window_handle
-        self._on_update_page = update_type
-        logging.debug(f"Finished reading in updates for {update_type} Updates.")
-        logging.debug(self.contents[update_type])
-
-
-    def download_latest_release(self, update_type, key, is_notes):
+    async def download_latest_release(self, update_type, key, is_notes):
         '''
         Download the page source of only the latest update.
 
+        Returns the path it was saved to, or None if nothing was downloaded.
+
         Non-keyword arguments:
         update_type -- a string determining update page to get from (Dynamic or Software)
         key -- a string showing the section to go through and download a release from
         is_notes -- a bool of whether you want release notes OR the raw files
         '''
-        if self._on_update_page != update_type:
-            self._find_update_page(update_type)
+        return await self._download_latest(update_type, key, is_notes)
+
+
+    async def download_many(self, update_type, keys, is_notes):
+        '''
+        Download the latest update of several sections off the same update page.
+
+        Non-keyword arguments:
+        update_type -- a string determining update page to get from (Dynamic or Software)
+        keys -- a list of the sections to download a release from
+        is_notes -- a bool of whether you want release notes OR the raw files
+        '''
+        await self._update_page(update_type)
+        await asyncio.gather(*[self._download_latest(update_type, key, is_notes) for key in keys])
+
+
+    async def _download_latest(self, update_type, key, is_notes):
+        '''
+        Download the latest release of one section, skipping sections the portal doesn't have.
+
+        Returns the path the release was saved to, or None if nothing was downloaded.
+
+        Non-keyword arguments:
+        update_type -- a string determining update page to get from (Dynamic or Software)
+        key -- a string showing the section to download a release from
+        is_notes -- a bool of whether you want release notes OR the raw files
+        '''
+        await self._update_page(update_type)
+        if key not in self._latest_idx[update_type]:
+            _LOG.warning("There's no %s section on the %s Updates page; skipping it.", key, update_type)
+            return None
+        return await self._download_release(update_type, key, is_notes, self._latest_release(update_type, key))
+
+
+    async def _update_page(self, update_type):
+        '''
+        Make sure the update page has been read in, fetching it exactly once.
+
+        Non-keyword arguments:
+        update_type -- a string determining update page to get from (Dynamic or Software)
+        '''
+        # Share one fetch of each update page between everybody waiting on it.
+        if update_type not in self._pages:
+            self._pages[update_type] = asyncio.ensure_future(self._find_update_page(update_type))
+        page = self._pages[update_type]
+        try:
+            await page
+        except BaseException:
+            if page.done() and self._pages.get(update_type) is page:
+                # Let the next caller try again.
+                del self._pages[update_type]
+            raise
+
+
+    async def _download_release(self, update_type, key, is_notes, release):
+        '''
+        Download one release, unless it has already been downloaded (or is downloading).
+
+        Returns the path the release was saved to, or None if the grid had no link for it.
+
+        Non-keyword arguments:
+        update_type -- a string determining update page to get from (Dynamic or Software)
+        key -- a string showing the section the release is from
+        is_notes -- a bool of whether you want release notes OR the raw files
+        release -- one of the section's releases from contents
+        '''
+        release_id = (update_type, key, is_notes, release['version'])
+        if release_id not in self._done:
+            self._done[release_id] = asyncio.ensure_future(self._save_release(update_type, key, is_notes, release))
+        download = self._done[release_id]
+        try:
+            # Shielded, so one caller giving up doesn't cancel the download for everyone else.
+            return await asyncio.shield(download)
+        except BaseException:
+            if download.done() and (download.cancelled() or download.exception() is not None) \
+                    and self._done.get(release_id) is download:
+                # Let the next caller try again.
+                del self._done[release_id]
+            raise
+
+
+    async def _save_release(self, update_type, key, is_notes, release):
+        '''
+        Download one release. Use _download_release, which skips repeats, instead.
 
-        logging.info(f"Downloading {update_type} {key} {'notes' if is_notes else 'raw files'} from version {self.contents[update_type][key]['version']} from support portal.")
+        Returns the path the release was saved to, or None if the grid had no link for it.
+
+        Non-keyword arguments:
+        update_type -- a string determining update page to get from (Dynamic or Software)
+        key -- a string showing the section the release is from
+        is_notes -- a bool of whether you want release notes OR the raw files
+        release -- one of the section's releases from contents
+        '''
+        _LOG.info("Downloading %s %s %s from version %s from support portal.",
+                  update_type, key, 'notes' if is_notes else 'raw files', release['version'])
+        if is_notes:
+            url = release['notes']
+            filename = f"Updates_{update_type}_{key}_{release['version']}.html"
+        else:
+            url = release['download']
+            filename = None
+        if url is None:
+            _LOG.warning("%s %s %s has no %s link; skipping it.",
+                         update_type, key, release['version'], 'notes' if is_notes else 'download')
+            return None
         while True:
-            try:
-                self.contents[update_type][key]['notes' if is_notes else 'download'].click()
-                break
-            except ElementClickInterceptedException:
-                # They're blocking the UI, try again.
-                pass
-        # Get the one window we've just opened (it will only open a new window for notes).
-        for handle in self._driver.window_handles:
-            if handle != self._main_handle:
-                self._driver.switch_to.window(handle)
-                # Save to disk
-                os.chdir(self._download_dir)
-                filename = f"Updates_{update_type}_{key}_{self.contents[update_type][key]['version']}.html"
-                with open(filename, 'w') as file:
-                    file.write(self._driver.page_source)
-                # Go back to previous page
-                self._driver.close()
-                self._driver.switch_to.window(self._main_handle)
+            logins = self._logins
+            async with self._get(url) as resp:
+                if str(resp.url) != _LOGGED_OUT_URL:
+                    resp.raise_for_status()
+                    return await self._save_response(resp, url, filename)
+            # Keep trying to log in.
+            await self._relogin(logins)
 
 
-    def _list_all_download_files(self):
+    async def _save_response(self, resp, url, filename):
         '''
-        See if there are any unfinished files in the download folder.
+        Stream a response into the download directory.
+
+        Returns the path it was saved to.
+
+        Non-keyword arguments:
+        resp -- the aiohttp response to save
+        url -- the url that was asked for, for error messages
+        filename -- the name to save it under, or None to use the one the portal gives
         '''
-        for (_, _, filenames) in os.walk(self._download_dir):
-            return str(filenames)
+        if filename is None:
+            # Keep the name the portal gives the file, but never let it pick the directory.
+            disposition = resp.content_disposition
+            name = disposition.filename if disposition and disposition.filename else resp.url.path
+            filename = os.path.basename(name.replace('\\', '/'))
+            if filename in ('', '.', '..'):
+                raise RuntimeError(f"No file name for the download at {url}")
+        path = os.path.join(self._download_dir, filename)
+        # Sections can share a file (the same image under two platforms); save each one once.
+        async with self._path_locks.setdefault(path, asyncio.Lock()):
+            if path in self._saved_paths:
+                _LOG.info("Already saved %s this run; not downloading it again.", path)
+                return path
+            # Write next to it and only replace the real file once the whole thing has arrived,
+            # so a failed download never clobbers a good copy.
+            fd, partial = tempfile.mkstemp(dir=self._download_dir, prefix=f"{filename}.", suffix='.part')
+            try:
+                # Stream to disk as it arrives instead of holding the whole file.
+                with os.fdopen(fd, 'wb', buffering=_WRITE_BUFFER) as file:
+                    async for chunk in resp.content.iter_chunked(_CHUNK_SIZE):
+                        file.write(chunk)
+                # mkstemp makes the file private; give it the permissions a plain open() would.
+                os.chmod(partial, 0o666 & ~_umask())
+                os.replace(partial, path)
+            except BaseException:
+                with suppress(FileNotFoundError):
+                    os.remove(partial)
+                raise
+            self._saved_paths.add(path)
+        return path
+
+
+
+def _umask():
+    '''Get the process's umask, which can only be read by setting it.'''
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+
+def _date_rank(release):
+    '''Sort key for a release's date; releases with unreadable dates come first (oldest).'''
+    return -1 if release['date_ts'] is None else release['date_ts']
+
+
+
+# Every (update type, section) whose latest release we download.
+TARGETS = [
+    ('Dynamic', 'Apps'),
+
+    ('Dynamic', 'WF-500 Content'),
+
+    # PanOS
+    ('Software', 'PAN-OS for the PA-200 Platform'),
+    ('Software', 'PAN-OS for the PA-220 Platform'),
+    ('Software', 'PAN-OS for the PA-500 Platform'),
+    ('Software', 'PAN-OS for the PA-800 Platform'),
+    ('Software', 'PAN-OS for the PA-2000 Platform'),
+    ('Software', 'PAN-OS for the PA-3000 Platform'),
+    ('Software', 'PAN-OS for the PA-3200 Platform'),
+    ('Software', 'PAN-OS for the PA-4000 Platform'),
+    ('Software', 'PAN-OS for the PA-5000 Platform'),
+    ('Software', 'PAN-OS for the PA-5200 Platform'),
+    ('Software', 'PAN-OS for the PA-7000 Platform'),
+    ('Software', 'PAN-OS for the PA-7000b Platform'),
+    ('Software', 'PAN-OS for VM-Series'),
+    ('Software', 'PAN-OS for VM-Series Base Images'),
+    ('Software', 'PAN-OS for VM-Series NSX Base Images'),
+    ('Software', 'PAN-OS for VM-Series SDX Base Images'),
+    ('Software', 'PAN-OS for VM-Series KVM Base Images'),
+    ('Software', 'PAN-OS for VM-Series Hyper-V Base Image'),
+
+    ('Software', 'GlobalProtect Agent Bundle'),
+
+    ('Software', 'Panorama M Images'),
+
+    ('Software', 'WF-500 Appliance Updates'),
+]
+
+
+
+async def download_all(scraper, targets=TARGETS):
+    '''
+    Fetch every release we track, all at once.
+
+    Non-keyword arguments:
+    scraper -- the SupportScraper to download with
+    targets -- a list of (update type, section) pairs to download the latest release of
+    '''
+    by_type = defaultdict(list)
+    for update_type, key in targets:
+        by_type[update_type].append(key)
+    try:
+        await asyncio.gather(*[scraper.download_many(update_type, keys, False)
+                               for update_type, keys in by_type.items()])
+    finally:
+        await scraper.close()
 
 
 
@@ -202,6 +638,7 @@ if __name__ == '__main__':
     # Config logging.
     dictConfig({
         'version': 1,
+        'disable_existing_loggers': False,
         'formatters': {'default': {
             'format': '[%(asctime)s] %(levelname)s in %(module)s: %(message)s',
         }},
@@ -216,37 +653,11 @@ if __name__ == '__main__':
         }
     })
 
-    scraper = SupportScraper(chrome_driver=os.getenv('DRIVER'),
-                             binary_location=os.getenv('BINARY_LOCATION'),
-                             download_dir=os.getenv('DEFAULT_DOWNLOAD_DIR'),
-                             login_time=os.getenv('LOGIN_TIME'))
-
-    scraper.download_latest_release('Dynamic', 'Apps', False)
-
-    scraper.download_latest_release('Dynamic', 'WF-500 Content', False)
-
-    # PanOS
-    scraper.download_latest_release('Software', 'PAN-OS for the PA-200 Platform', False)
-    scraper.download_latest_release('Software', 'PAN-OS for the PA-220 Platform', False)
-    scraper.download_latest_release('Software', 'PAN-OS for the PA-500 Platform', False)
-    scraper.download_latest_release('Software', 'PAN-OS for the PA-800 Platform', False)
-    scraper.download_latest_release('Software', 'PAN-OS for the PA-2000 Platform', False)
-    scraper.download_latest_release('Software', 'PAN-OS for the PA-3000 Platform', False)
-    scraper.download_latest_release('Software', 'PAN-OS for the PA-3200 Platform', False)
-    scraper.download_latest_release('Software', 'PAN-OS for the PA-4000 Platform', False)
-    scraper.download_latest_release('Software', 'PAN-OS for the PA-5000 Platform', False)
-    scraper.download_latest_release('Software', 'PAN-OS for the PA-5200 Platform', False)
-    scraper.download_latest_release('Software', 'PAN-OS for the PA-7000 Platform', False)
-    scraper.download_latest_release('Software', 'PAN-OS for the PA-7000b Platform', False)
-    scraper.download_latest_release('Software', 'PAN-OS for VM-Series', False)
-    scraper.download_latest_release('Software', 'PAN-OS for VM-Series Base Images', False)
-    scraper.download_latest_release('Software', 'PAN-OS for VM-Series NSX Base Images', False)
-    scraper.download_latest_release('Software', 'PAN-OS for VM-Series SDX Base Images', False)
-    scraper.download_latest_release('Software', 'PAN-OS for VM-Series KVM Base Images', False)
-    scraper.download_latest_release('Software', 'PAN-OS for VM-Series Hyper-V Base Image', False)
-
-    scraper.download_latest_release('Software', 'GlobalProtect Agent Bundle', False)
-
-    scraper.download_latest_release('Software', 'Panorama M Images', False)
-
-    scraper.download_latest_release('Software', 'WF-500 Appliance Updates', False)
+    with SupportScraper(chrome_driver=os.getenv('DRIVER'),
+                        binary_location=os.getenv('BINARY_LOCATION'),
+                        download_dir=os.getenv('DEFAULT_DOWNLOAD_DIR'),
+                        login_time=os.getenv('LOGIN_TIME'),
+                        cookie_file=os.getenv('COOKIE_FILE'),
+                        headless=os.getenv('HEADLESS'),
+                        remote_url=os.getenv('SELENIUM_REMOTE_URL')) as scraper:
+        asyncio.run(download_all(scraper))